@@ -65,7 +65,7 @@ def handle_file(file_name, output_name, out_type, path = False, heat = False,
     df = load_data(file_name)
     df = combine_df(df)
     
-    ann_file = glob.glob(file_name.strip('.csv') + '.*.ann')[0] 
+    ann_file = glob.glob(split_data_filename(file_name)[0] + '.*.ann')[0] 
     coords = get_top_and_bottom(ann_file)
     
     if path:
@@ -7,13 +7,23 @@ Justin W. Kenney
 jkenney9a@gmail.com
 
 Parameters: 
---Input=<input file name>
+--Input=<input file name> (.csv, .csv.gz, .csv.zst or .txt list)
 --Output=<output file name>
 --time= OR fps= the time length of trial or the fps of the video analyzed
 --x= OR --y= the maximum x or y length in the .ann ROI
 --long= whether or not to output data as a long format
 --measure= the measure to use for long format output (default is distance travelled)
 --noisy= whether or not to print out when files are done being analyzed (default = TRUE)
+--qc=<QC output file name> write tracking quality control measures for each file
+--maxjump= largest plausible movement of the fish between frames (in pixels)
+--jumps= how to handle larger jumps for distance/freezing: exclude or clamp
+(needs --maxjump)
+--maxdropout= largest fraction of frames without tracking before a file is 
+flagged in the QC output (default = 0.05)
+--maxoutside= largest fraction of frames outside the ROI before a file is
+flagged in the QC output (default = 0.01)
+--maxjumps= largest fraction of frames with implausible jumps before a file is
+flagged in the QC output (default = 0.001)
 
 Output:
 CSV file listing the percent time fish spends in different parts of tank divided
@@ -28,16 +38,193 @@ import pandas as pd #Use dataframes to organize data
 import pickle #To unpickle the tank coordinates out of the .ann file
 import numpy as np
 import glob #For use of wild cards in getting .ann files
+import os
+import gzip #For reading compressed CSV files
+import threading #To decompress files in the background while parsing
+import Queue
+import collections
+
+try:
+    import zstandard as zstd #Optional; only needed for .zst files (>= 0.14)
+except ImportError:
+    zstd = None
 
 pd.set_option('display.precision',5)
 
+#Compression extensions that can follow .csv in an input filename
+COMPRESSED_EXTENSIONS = ['.gz', '.zst']
+
+
+class ThreadedDecompressor(object):
+    """
+    File-like object that pulls decompressed data in a background thread
+    so that decompression overlaps with parsing of the CSV data.
+    
+    Input: an iterator of chunks of decompressed data (e.g., from 
+    iter_decompressed) and the number of chunks to buffer
+    """
+    
+    def __init__(self, chunks, max_chunks=8):
+        self._queue = Queue.Queue(maxsize=max_chunks)
+        #Buffered chunks and the position reached in the first one
+        self._chunks = collections.deque()
+        self._offset = 0
+        self._done = False
+        self._closed = False
+        self._error = None
+        self._thread = threading.Thread(target=self._fill, args=(chunks,))
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def _fill(self, chunks):
+        try:
+            for chunk in chunks:
+                if self._closed:
+                    break
+                self._queue.put(chunk)
+        except Exception as e:
+            self._error = e
+        finally:
+            #None marks the end of the stream; queue it before cleaning up so
+            #that readers can never be left waiting
+            self._queue.put(None)
+            if hasattr(chunks, 'close'):
+                try:
+                    chunks.close()
+                except Exception:
+                    pass
+    
+    def _pull(self):
+        #Move the next decompressed chunk from the queue onto the buffer
+        chunk = self._queue.get()
+        if chunk is None:
+            self._done = True
+            if self._error is not None:
+                raise self._error
+        elif chunk:
+            self._chunks.append(chunk)
+    
+    def _take(self, size):
+        #Remove up to size bytes from the first buffered chunk
+        chunk = self._chunks[0]
+        data = chunk[self._offset:self._offset + size]
+        self._offset += len(data)
+        if self._offset == len(chunk):
+            self._chunks.popleft()
+            self._offset = 0
+        return data
+    
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if not self._chunks:
+                if self._done:
+                    break
+                self._pull()
+                continue
+            if size < 0:
+                parts.append(self._take(len(self._chunks[0])))
+            else:
+                parts.append(self._take(size))
+                size -= len(parts[-1])
+        return ''.join(parts)
+    
+    def __iter__(self):
+        #Only needed by the python parsing engine; the C engine uses read()
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+    
+    def readline(self):
+        parts = []
+        while True:
+            if not self._chunks:
+                if self._done:
+                    break
+                self._pull()
+                continue
+            end = self._chunks[0].find('\n', self._offset)
+            if end != -1:
+                parts.append(self._take(end + 1 - self._offset))
+                break
+            parts.append(self._take(len(self._chunks[0])))
+        return ''.join(parts)
+    
+    def close(self):
+        #Let the background thread finish if parsing stopped early
+        self._closed = True
+        while not self._done:
+            if self._queue.get() is None:
+                self._done = True
+        self._thread.join()
+
+
+def split_data_filename(filename):
+    """
+    Input: filename of Ctrax CSV output, optionally compressed 
+    (e.g., trial.csv, trial.csv.gz or trial.csv.zst)
+    
+    Output: tuple of the filename without the .csv and compression extensions
+    and the compression extension ('' if the file is not compressed)
+    """
+    compression = ''
+    for ext in COMPRESSED_EXTENSIONS:
+        if filename.lower().endswith(ext):
+            compression = ext
+            filename = filename[:-len(ext)]
+            break
+    
+    if filename.lower().endswith('.csv'):
+        filename = filename[:-len('.csv')]
+    
+    return filename, compression
+
+
+def iter_decompressed(filename, compression, chunk_size=1024*1024):
+    """
+    Input: filename, compression extension (.gz or .zst) and the size of 
+    chunks to read
+    
+    Output: generator of chunks of decompressed data. Files made of several
+    concatenated gzip members or zstd frames are read in full.
+    """
+    if compression not in COMPRESSED_EXTENSIONS:
+        raise ValueError("Unsupported compression type: " + compression)
+    if compression == '.zst' and zstd is None:
+        raise ImportError("The zstandard package is needed to read .zst files")
+    
+    with open(filename, 'rb') as f:
+        #Both readers carry on across concatenated gzip members/zstd frames
+        if compression == '.gz':
+            reader = gzip.GzipFile(fileobj=f, mode='rb')
+        elif compression == '.zst':
+            reader = zstd.ZstdDecompressor().stream_reader(f, 
+                                                           read_across_frames=True)
+        
+        chunk = reader.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = reader.read(chunk_size)
+
+
 def load_data(filename):
     """
-    Input: filename
+    Input: filename (plain .csv or compressed .csv.gz/.csv.zst)
     
     Output: dataframe (df) object of data
-    """    
-    return pd.read_csv(filename, header=None)
+    """
+    compression = split_data_filename(filename)[1]
+    
+    if compression == '':
+        return pd.read_csv(filename, header=None)
+    
+    #Decompress in a background thread while pandas parses the data
+    stream = ThreadedDecompressor(iter_decompressed(filename, compression))
+    try:
+        return pd.read_csv(stream, header=None)
+    finally:
+        stream.close()
     
 
 def combine_df(df):
@@ -48,30 +235,148 @@ def combine_df(df):
     combines different IDs from ctrax into one track.
     """
     
-    coordinates = {'x':[], 'y':[]}
+    return combine_df_with_qc(df)[0]
+
+def combine_df_with_qc(df, tank_coordinates=None, max_jump=None, jumps=None):
+    """
+    Input: dataframe of tracking data (from CSV file), 
+    tank_coordinates = dict of top/bottom/left/right of ROI (optional)
+    max_jump = largest plausible per-frame movement in pixels (optional)
+    jumps = how to handle implausible jumps for distance/freezing measures:
+    None (keep), "exclude" (leave out of distance and freezing measures) or 
+    "clamp" (limit to max_jump); needs max_jump
+    
+    Output: dataframe of x and y coordinates of fish (plus their per-frame 
+    changes, dx and dy, used for distance measures if jumps is given; NaN for
+    excluded jumps), and a dict of tracking quality control (QC) measures. 
+    Assumes one fish and combines different IDs from ctrax into one track.
+    """
     
-    for frame in df.index:
-        
-        #Get x,y coordinates of all ids present in file. The CSV output files
-        #from Ctrax are setup in blocks of 6 columns where the 1st is the ID
-        # and the 2nd and 3rd or the x and y coordinates, respectively.        
-        tracker_ids = range(0,len(df.columns),6)
-        x_temp = []
-        y_temp = []
-        
-        for ids in tracker_ids:
-            #Ids without tracking info are "-1" in the CSV file under ID
-            if df[ids][frame] >= 0:
-                x_temp.append(df[ids + 1][frame])
-                y_temp.append(df[ids + 2][frame])
-        
-        #Take the last of the appended coordinates (i.e, last id) and throw out
-        #any spurious detections (i.e., len > 0)
-        if len(x_temp) > 0:
-            coordinates['x'].append(x_temp[-1])
-            coordinates['y'].append(y_temp[-1])
+    if jumps not in [None, "exclude", "clamp"]:
+        raise ValueError("Invalid jump handling: must be 'exclude' or 'clamp'")
+    if jumps is not None and max_jump is None:
+        raise ValueError("max_jump is needed to exclude or clamp jumps")
+    
+    #The CSV output files from Ctrax are setup in blocks of 6 columns where the 
+    #1st is the ID and the 2nd and 3rd or the x and y coordinates, respectively.
+    data = df.values.astype(float)
+    ids = data[:, 0::6]
+    
+    #Ids without tracking info are "-1" in the CSV file under ID
+    tracked = ids >= 0
+    detected = tracked.any(axis=1)
+    
+    #Take the last tracked id in each frame and throw out any spurious 
+    #detections and frames without any tracking info
+    last = ids.shape[1] - 1 - np.argmax(tracked[:, ::-1], axis=1)
+    frames = np.arange(len(data))[detected]
+    last = last[detected]
+    
+    x = data[frames, last*6 + 1]
+    y = data[frames, last*6 + 2]
+    
+    #Change in position from the previous frame (none for the first frame)
+    dx = np.zeros(len(x))
+    dx[1:] = np.diff(x)
+    dy = np.zeros(len(y))
+    dy[1:] = np.diff(y)
+    step = np.sqrt(dx**2 + dy**2)
+    
+    qc = {}
+    qc['frames'] = len(data)
+    if len(data) > 0:
+        qc['dropout fraction'] = 1 - len(frames) / float(len(data))
+    else:
+        qc['dropout fraction'] = np.nan
+    qc['ID switches'] = int(np.count_nonzero(np.diff(ids[frames, last])))
+    
+    if tank_coordinates is not None:
+        outside = ((x < tank_coordinates['left']) | 
+                   (x > tank_coordinates['right']) |
+                   (y < tank_coordinates['bottom']) | 
+                   (y > tank_coordinates['top']))
+        qc['frames outside ROI'] = int(np.count_nonzero(outside))
+    else:
+        qc['frames outside ROI'] = np.nan
+    
+    if max_jump is not None:
+        jumped = step > max_jump
+        qc['implausible jumps'] = int(np.count_nonzero(jumped))
         
-    return pd.DataFrame(coordinates, columns = ['x','y'])
+        if jumps == "exclude":
+            dx[jumped] = np.nan
+            dy[jumped] = np.nan
+        elif jumps == "clamp":
+            scale = max_jump / step[jumped]
+            dx[jumped] = dx[jumped] * scale
+            dy[jumped] = dy[jumped] * scale
+    else:
+        qc['implausible jumps'] = np.nan
+    
+    if jumps is not None:
+        df_out = pd.DataFrame({'x': x, 'y': y, 'dx': dx, 'dy': dy}, 
+                              columns = ['x', 'y', 'dx', 'dy'])
+    else:
+        df_out = pd.DataFrame({'x': x, 'y': y}, columns = ['x', 'y'])
+    
+    return df_out, qc
+
+QC_COLUMNS = ['filename', 'frames', 'dropout fraction', 'ID switches',
+              'frames outside ROI', 'implausible jumps', 'flagged']
+
+def flag_qc(qc, max_dropout=0.05, max_outside=0.01, max_jumps=0.001):
+    """
+    Input: dict of QC measures from combine_df_with_qc and the largest 
+    acceptable fractions of frames without tracking info, outside the ROI 
+    and with implausible jumps
+    
+    Output: True if trial should be checked by eye, otherwise False
+    """
+    
+    if qc['frames'] == 0:
+        return True
+    elif qc['dropout fraction'] > max_dropout:
+        return True
+    elif qc['frames outside ROI'] / float(qc['frames']) > max_outside:
+        return True
+    elif qc['implausible jumps'] / float(qc['frames']) > max_jumps:
+        return True
+    else:
+        return False
+
+def qc_row(qc, filename, max_dropout=0.05, max_outside=0.01, max_jumps=0.001):
+    """
+    Input: dict of QC measures from combine_df_with_qc, the filename 
+    associated with them and the thresholds for flagging (see flag_qc)
+    
+    Output: dict of QC measures ready to be written as a row of the QC file
+    """
+    
+    row = dict(qc)
+    row['filename'] = filename
+    row['flagged'] = flag_qc(qc, max_dropout=max_dropout, 
+                             max_outside=max_outside, max_jumps=max_jumps)
+    
+    return row
+    
+def write_qc_row(qc_file, qc, filename, max_dropout=0.05, max_outside=0.01,
+                 max_jumps=0.001):
+    """
+    Input: open QC output file (or None to skip), dict of QC measures from 
+    combine_df_with_qc, the filename associated with them and the thresholds
+    for flagging (see flag_qc)
+    
+    Output: None, appends a row to the QC output file
+    """
+    
+    if qc_file is None:
+        return
+    
+    row = pd.DataFrame([qc_row(qc, filename, max_dropout, max_outside, max_jumps)],
+                       columns = QC_COLUMNS)
+    row.to_csv(qc_file, header=False, index=False)
+    #Keep the rows written so far if a later file in the batch fails
+    qc_file.flush()
 
 def analyze_frame_left_right(df, frame, left, right):
     """
@@ -165,6 +470,50 @@ def distance_travelled(df, frame, bin_size = 1):
         return d
     else:
         return 0
+
+def binned_distances(df, bin_size = 1):
+    """
+    Input: Dataframe of tracking data (with dx and dy from combine_df_with_qc
+    if jumps were filtered) and bin size (default = 1 frame)
+    
+    Output: arrays giving, for the bin starting at each frame, the distance
+    travelled in pixel distance (as in distance_travelled, leaving out 
+    excluded jumps) and whether the bin contains an excluded jump
+    """
+    
+    n = len(df.index)
+    
+    if 'dx' in df.columns and 'dy' in df.columns:
+        dx = df['dx'].values
+        dy = df['dy'].values
+    else:
+        dx = np.zeros(n)
+        dx[1:] = np.diff(df['x'].values)
+        dy = np.zeros(n)
+        dy[1:] = np.diff(df['y'].values)
+    
+    excluded = np.isnan(dx) | np.isnan(dy)
+    
+    #Running totals of movement so each bin is the difference of two totals
+    x_sums = np.zeros(n + 1)
+    x_sums[1:] = np.cumsum(np.where(excluded, 0, abs(dx)))
+    y_sums = np.zeros(n + 1)
+    y_sums[1:] = np.cumsum(np.where(excluded, 0, abs(dy)))
+    excluded_sums = np.zeros(n + 1, dtype=int)
+    excluded_sums[1:] = np.cumsum(excluded)
+    
+    #Bin starting at a frame covers the changes into the next bin_size frames
+    start = np.arange(n) + 1
+    end = np.minimum(start + bin_size, n)
+    
+    distance = np.sqrt((x_sums[end] - x_sums[start])**2 + 
+                       (y_sums[end] - y_sums[start])**2)
+    #As in distance_travelled, bins running past the end of the data are 0
+    distance[start + bin_size >= n] = 0
+    
+    bin_excluded = (excluded_sums[end] - excluded_sums[start]) > 0
+    
+    return distance, bin_excluded
     
         
 def min_by_min_top_bottom_analysis(df, tank_coordinates, trial, freeze_bin=0.5, 
@@ -204,6 +553,12 @@ def min_by_min_top_bottom_analysis(df, tank_coordinates, trial, freeze_bin=0.5,
             print "WARNING. Invalid distance measure entered. Must be 'x' or 'y'"
     else:
         pix_con = 0
+    
+    #If a conversion factor is given, freezing tolerance is in real distances
+    if pix_con != 0:
+        freeze_scale = pix_con
+    else:
+        freeze_scale = 1
         
      
     if mode.lower() == "time":
@@ -215,6 +570,10 @@ def min_by_min_top_bottom_analysis(df, tank_coordinates, trial, freeze_bin=0.5,
         frames_per_min = int(len(df.index) / trial_length)
         frames_per_bin = int((frames_per_min/60)*freeze_bin)
         
+        #Distance over each freezing bin and each frame for the whole trial
+        bin_distance, bin_excluded = binned_distances(df, frames_per_bin)
+        frame_distance = binned_distances(df)[0]
+        
         #Find frames at each minute boundary    
         frame_index = [x*frames_per_min for x in range(0,trial_length + 1)]
         
@@ -224,6 +583,8 @@ def min_by_min_top_bottom_analysis(df, tank_coordinates, trial, freeze_bin=0.5,
             
             #Initialize all parameters to zero
             Output = {x: 0 for x in Parameters}
+            #Frames where freezing could be scored (i.e., no excluded jumps)
+            freeze_frames = 0
            
             for frame in frames:
                 #Find fish top/bottom
@@ -235,17 +596,21 @@ def min_by_min_top_bottom_analysis(df, tank_coordinates, trial, freeze_bin=0.5,
                 for where in whereabouts:
                     Output[where] += 1
                 
-                if analyze_freezing(df, frame, bin_size = frames_per_bin, 
-                                    tolerance = freeze_tolerance, 
-                                    pix_con = pix_con):
-                    Output['freezing'] += 1
+                #Freezing can't be scored over bins with excluded jumps
+                if not bin_excluded[frame]:
+                    freeze_frames += 1
+                    if bin_distance[frame] * freeze_scale < freeze_tolerance:
+                        Output['freezing'] += 1
                     
                 Output['distance from bottom'] += distance_from_bottom(df, frame, bottom)
                 
-                Output['distance travelled'] += distance_travelled(df, frame)
+                Output['distance travelled'] += frame_distance[frame]
             
             for x in Output.keys():
-                if x != 'distance travelled': #Don't want avg dist. travelled!
+                if x == 'freezing':
+                    if freeze_frames > 0:
+                        df_out[i + 1][x] = (Output[x]/ float(freeze_frames)) * 100
+                elif x != 'distance travelled': #Don't want avg dist. travelled!
                     df_out[i + 1][x] = (Output[x]/ float(len(frames))) * 100
                 else:
                     df_out[i + 1][x] = np.float64(Output[x])
@@ -254,6 +619,10 @@ def min_by_min_top_bottom_analysis(df, tank_coordinates, trial, freeze_bin=0.5,
         fps = trial
         fpm = fps*60
         frames_per_bin = int(fps*freeze_bin)
+        
+        #Distance over each freezing bin and each frame for the whole trial
+        bin_distance, bin_excluded = binned_distances(df, frames_per_bin)
+        frame_distance = binned_distances(df)[0]
         trial_length = float(len(df.index)) / fpm
         time_intervals = range(1,int(trial_length + 1))
        
@@ -269,6 +638,8 @@ def min_by_min_top_bottom_analysis(df, tank_coordinates, trial, freeze_bin=0.5,
             
             #Initialize all parameters to zero
             Output = {x: 0 for x in Parameters}
+            #Frames where freezing could be scored (i.e., no excluded jumps)
+            freeze_frames = 0
             
             for frame in frames:
                 whereabouts = analyze_frame_top_bottom(df, frame, top, bottom)
@@ -279,17 +650,21 @@ def min_by_min_top_bottom_analysis(df, tank_coordinates, trial, freeze_bin=0.5,
                 for where in whereabouts:
                     Output[where] += 1
                 
-                if analyze_freezing(df, frame, bin_size = frames_per_bin,
-                                    tolerance = freeze_tolerance,
-                                    pix_con = pix_con):
-                    Output['freezing'] += 1
+                #Freezing can't be scored over bins with excluded jumps
+                if not bin_excluded[frame]:
+                    freeze_frames += 1
+                    if bin_distance[frame] * freeze_scale < freeze_tolerance:
+                        Output['freezing'] += 1
                 
                 Output['distance from bottom'] += distance_from_bottom(df, frame, bottom)
                 
-                Output['distance travelled'] += distance_travelled(df, frame)
+                Output['distance travelled'] += frame_distance[frame]
                     
             for x in Output.keys():
-                if x != "distance travelled": #Don't want avg dist. travelled!
+                if x == "freezing":
+                    if freeze_frames > 0:
+                        df_out[time_intervals[t+1]][x] = (float(Output[x]) / freeze_frames) * 100
+                elif x != "distance travelled": #Don't want avg dist. travelled!
                     df_out[time_intervals[t+1]][x] = (float(Output[x]) / len(frames)) * 100
                 else:
                     df_out[time_intervals[t+1]][x] = float(Output[x])
@@ -345,25 +720,39 @@ def pixel_to_length(pixel_length, real_length):
 
 def analyze_file(files, file_type, output, mode, use_real_dist, real_len, noisy,
                  freeze_bin = 0.5, freeze_tolerance = 2, long_format=False,
-                 measure='distance travelled'):
+                 measure='distance travelled', qc_output=None, max_jump=None,
+                 jumps=None, max_dropout=0.05, max_outside=0.01, max_jumps=0.001):
     """
     Analyzes files
     
-    Input: list of filenames, file_type = .txt or .csv, output file name,
+    Input: list of filenames, file_type = .txt or .csv (.csv files may be
+    compressed as .csv.gz or .csv.zst), output file name,
     mode ("time=xx" or "fps=xx"), whether to use real distance and the associated
     length (use_real_dist and real_len), bin size (sec) and tolerance to use for
-    freezing calculations
+    freezing calculations, QC output file name (optional), largest plausible
+    per-frame movement in pixels and how to handle larger jumps 
+    ("exclude" or "clamp"), and the largest acceptable fractions of frames 
+    without tracking, outside the ROI and with implausible jumps
     
-    Output: None, writes data to the output file
+    Output: None, writes data to the output file and QC measures for each
+    file to the QC output file
     """
     if file_type == ".txt":
-        f = open(sys.argv[1])
-        files = [filename.strip('\n') for filename in f]
-        files = [filename.strip('.csv') for filename in files]
+        f = open(files)
+        files = [split_data_filename(filename.strip('\n')) for filename in f]
         f.close()
     
     output_file = open(output,'a')
     
+    if qc_output is not None:
+        #Only add the header if this is a new QC file
+        new_qc_file = not os.path.exists(qc_output) or os.path.getsize(qc_output) == 0
+        qc_file = open(qc_output,'a')
+        if new_qc_file:
+            qc_file.write(','.join(QC_COLUMNS) + '\n')
+    else:
+        qc_file = None
+    
     mode_type = mode[:mode.find('=')].lower()
     
     if mode_type == "time":
@@ -375,13 +764,15 @@ def analyze_file(files, file_type, output, mode, use_real_dist, real_len, noisy,
         blank_line = pd.DataFrame(blanks, index = [1], columns = range(trial_length))
         
         if file_type == ".txt":
-            for filename in files:
-                df = load_data(filename + ".csv")
-                df = combine_df(df)
+            for filename, compression in files:
+                df = load_data(filename + ".csv" + compression)
                 #glob.glob returns a list; just need element of list.
                 #This allows for the use of other types of movies besides .avi
                 ann_file = glob.glob(filename + ".*.ann")[0]              
                 t_b = get_top_and_bottom(ann_file)
+                df, qc = combine_df_with_qc(df, t_b, max_jump=max_jump, jumps=jumps)
+                write_qc_row(qc_file, qc, filename + ".csv" + compression,
+                             max_dropout, max_outside, max_jumps)
                 df_out = min_by_min_top_bottom_analysis(df, t_b, trial=trial_length,
                                                         freeze_bin=freeze_bin,
                                                         freeze_tolerance=freeze_tolerance,
@@ -402,9 +793,10 @@ def analyze_file(files, file_type, output, mode, use_real_dist, real_len, noisy,
         
         elif file_type == '.csv':
             df = load_data(files)
-            df = combine_df(df)
-            ann_file = glob.glob(files.strip('.csv') + '.*.ann')[0] 
+            ann_file = glob.glob(split_data_filename(files)[0] + '.*.ann')[0] 
             t_b = get_top_and_bottom(ann_file)
+            df, qc = combine_df_with_qc(df, t_b, max_jump=max_jump, jumps=jumps)
+            write_qc_row(qc_file, qc, files, max_dropout, max_outside, max_jumps)
             df_out = min_by_min_top_bottom_analysis(df, t_b, trial=trial_length,
                                                         freeze_bin=freeze_bin,
                                                         freeze_tolerance=freeze_tolerance,
@@ -427,9 +819,13 @@ def analyze_file(files, file_type, output, mode, use_real_dist, real_len, noisy,
     elif mode_type == "fps":
         
         if file_type == ".txt":
-            for filename in files:
-                df = load_data(filename + ".csv")
-                df = combine_df(df)
+            for filename, compression in files:
+                df = load_data(filename + ".csv" + compression)
+                ann_file = glob.glob(filename + ".*.ann")[0]
+                t_b = get_top_and_bottom(ann_file)
+                df, qc = combine_df_with_qc(df, t_b, max_jump=max_jump, jumps=jumps)
+                write_qc_row(qc_file, qc, filename + ".csv" + compression,
+                             max_dropout, max_outside, max_jumps)
                 fps = float(mode[mode.find('=')+1:])
                 fpm = fps*60 #Calculate frames per minute
                 trial_length = float(len(df.index)/float(fpm))
@@ -440,8 +836,6 @@ def analyze_file(files, file_type, output, mode, use_real_dist, real_len, noisy,
                 blanks = int(trial_length + 1) * " "
                 blank_line = pd.DataFrame(blanks, index = [1], 
                                           columns = range(int(trial_length)))
-                ann_file = glob.glob(filename + ".*.ann")[0]
-                t_b = get_top_and_bottom(ann_file)
                 
                 df_out = min_by_min_top_bottom_analysis(df, t_b, trial=trial_length,
                                                         freeze_bin=freeze_bin,
@@ -462,7 +856,10 @@ def analyze_file(files, file_type, output, mode, use_real_dist, real_len, noisy,
             
         elif file_type == ".csv":
             df = load_data(files)
-            df = combine_df(df)
+            ann_file = glob.glob(split_data_filename(files)[0] + '.*.ann')[0]
+            t_b = get_top_and_bottom(ann_file)
+            df, qc = combine_df_with_qc(df, t_b, max_jump=max_jump, jumps=jumps)
+            write_qc_row(qc_file, qc, files, max_dropout, max_outside, max_jumps)
             fps = float(mode[mode.find('=')+1:])
             fpm = fps*60 #Calculate frames per minute
             trial_length = float(len(df.index)/float(fpm))
@@ -472,9 +869,6 @@ def analyze_file(files, file_type, output, mode, use_real_dist, real_len, noisy,
             blank_line = pd.DataFrame(blanks, index = [1], 
                                       columns = range(int(trial_length)))
             
-            ann_file = glob.glob(files.strip('.csv') + '.*.ann')[0]
-            t_b = get_top_and_bottom(ann_file)
-            
             df_out = min_by_min_top_bottom_analysis(df, t_b, trial=trial_length,
                                                         freeze_bin=freeze_bin,
                                                         freeze_tolerance=freeze_tolerance,
@@ -494,6 +888,8 @@ def analyze_file(files, file_type, output, mode, use_real_dist, real_len, noisy,
             
             
     output_file.close()
+    if qc_file is not None:
+        qc_file.close()
     
 def convert_to_long_format(df, filename, measure):
     """
@@ -524,6 +920,12 @@ if __name__ == "__main__":
     long_format=False
     measure = "distance travelled"
     noisy = True
+    qc_output = None
+    max_jump = None
+    jumps = None
+    max_dropout = 0.05
+    max_outside = 0.01
+    max_jumps = 0.001
     
     for arg in sys.argv[1:]:
         try:
@@ -560,18 +962,50 @@ if __name__ == "__main__":
             
         elif name.lower() == "--noisy":
             noisy = value
+        
+        elif name.lower() == "--qc":
+            qc_output = value
+        
+        elif name.lower() == "--maxjump":
+            max_jump = float(value)
+        
+        elif name.lower() == "--jumps":
+            jumps = value.lower()
+            if jumps not in ["exclude", "clamp"]:
+                print "Invalid jump handling entered. Must be 'exclude' or 'clamp'"
+                sys.exit(1)
+        
+        elif name.lower() == "--maxdropout":
+            max_dropout = float(value)
+        
+        elif name.lower() == "--maxoutside":
+            max_outside = float(value)
+        
+        elif name.lower() == "--maxjumps":
+            max_jumps = float(value)
+    
+    if jumps is not None and max_jump is None:
+        print "--jumps needs --maxjump to be set"
+        sys.exit(1)
     
     file_type = files[files.find('.'):].lower()
     
+    #Compressed CSV files are handled the same as plain CSV files
+    if file_type == ".csv" + split_data_filename(files)[1]:
+        file_type = ".csv"
+    
     if file_type.lower() == ".txt" or file_type.lower() == ".csv":
         analyze_file(files, file_type, output, mode, use_real_dist, real_len,
                      freeze_bin = fbin, freeze_tolerance = ftol,
-                     long_format=long_format, measure=measure, noisy=noisy)
+                     long_format=long_format, measure=measure, noisy=noisy,
+                     qc_output=qc_output, max_jump=max_jump, jumps=jumps,
+                     max_dropout=max_dropout, max_outside=max_outside,
+                     max_jumps=max_jumps)
     
     else:
         print "Not a supported file type."
         print "File must be a list of filenames in a .txt file or .csv output"
-        print "from Ctrax."
+        print "from Ctrax (optionally compressed as .csv.gz or .csv.zst)."
 
 
     